@@ -0,0 +1,42 @@
+#! /usr/bin/env python3
+
+import argparse
+import os
+
+from ipynb_common import evict_cache, load_cache_statistics
+
+MAX_SIZE = 1024 # MiB
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-C', '--cache_dir', required=True, help='Specify a directory of the build cache.')
+    parser.add_argument('-m', '--max_size', type=int, metavar='MIB', help=f'Evict least recently used entries to keep the cache within a specified size in MiB (e.g., {MAX_SIZE}).')
+    parser.add_argument('-s', '--statistics', action='store_true', help='Print the hits and misses of the cache.')
+    commandline_args = parser.parse_args()
+
+    if not os.path.isdir(commandline_args.cache_dir):
+        print(f'[INFO] {commandline_args.cache_dir} does not exist.')
+        return
+    if commandline_args.max_size is not None:
+        removed_count, removed_size, total_size = evict_cache(commandline_args.cache_dir, commandline_args.max_size * 1024 * 1024)
+        print(f'{commandline_args.cache_dir} evicted: {removed_count} entries ({removed_size} bytes) removed, {total_size} bytes remaining')
+    if commandline_args.statistics:
+        print_statistics(load_cache_statistics(commandline_args.cache_dir))
+
+
+def print_statistics(statistics):
+    total_hits, total_misses = 0, 0
+    for namespace, counts in sorted(statistics.items()):
+        print(f'  - {namespace}: {counts["hits"]} hits, {counts["misses"]} misses{hit_ratio(counts["hits"], counts["misses"])}')
+        total_hits += counts['hits']
+        total_misses += counts['misses']
+    print(f'  total: {total_hits} hits, {total_misses} misses{hit_ratio(total_hits, total_misses)}')
+
+
+def hit_ratio(hits, misses):
+    return f' ({hits / (hits + misses):.1%})' if hits + misses else ''
+
+
+if __name__ == '__main__':
+    main()
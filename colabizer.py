@@ -7,7 +7,8 @@ import sys
 import json
 import shutil
 import io
-import contextlib
+
+from ipynb_common import cache_key, source_digest, cached, dumps_ipynb, write_ipynb, write_file, scan_tree, scan_subtree, clear_scan_cache
 
 if (sys.version_info.major, sys.version_info.minor) < (3, 8):
     print('[ERROR] This script requires Python >= 3.8.')
@@ -19,8 +20,6 @@ URL_BASE = 'https://username.github.io/reponame/'
 
 IGNORE_PATTERNS = ('.*', '*~', '__pycache__')
 
-DOWNLOAD_IGNORE_FILE = '.download_ignore'
-
 HEADER_NOTICE = """
 ##================================================
 ## このセルを最初に実行せよ---Run this cell first.
@@ -48,69 +47,82 @@ def colabize_ipynb(source, public_base, dest_base, url_base, ignore_patterns=Non
     assert not source_dir.startswith('..')
     assert filename.endswith('.ipynb')
     public_dir = os.path.join(public_base, source_dir)
-    ignore = shutil.ignore_patterns('*.ipynb', *(IGNORE_PATTERNS if ignore_patterns is None else ignore_patterns))
-    shutil.copytree(source_dir, public_dir, ignore=ignore, dirs_exist_ok=True)
-
-    try:
-        with open(os.path.join(source_dir, DOWNLOAD_IGNORE_FILE), encoding='utf-8') as f:
-            ignore = shutil.ignore_patterns(*f.read().splitlines())
-    except FileNotFoundError:
-        ignore = None
+    files = scan_subtree(source_dir, IGNORE_PATTERNS if ignore_patterns is None else ignore_patterns)
+    copy_public_files(files, source_dir, public_dir)
 
     with open(source, encoding='utf-8') as f:
         ipynb = json.load(f)
     ref_imgs = replace_img_links(ipynb['cells'], os.path.join(url_base, source_dir))
-    header = make_colab_header(public_dir, public_base, url_base, ref_imgs, ignore)
+    header = make_colab_header(public_dir, public_base, url_base, ref_imgs, list_download_files(files, ''))
     if header['source']:
         ipynb['cells'].insert(0, header)
     os.makedirs(os.path.join(dest_base, source_dir), exist_ok=True)
-    with open(os.path.join(dest_base, source_dir, filename), 'w', encoding='utf-8', newline='\n') as f:
-        json.dump(ipynb, f, indent=1, ensure_ascii=False)
-        f.write('\n')
+    write_ipynb(os.path.join(dest_base, source_dir, filename), ipynb)
+    clear_scan_cache()
 
 
-def colabize_directory(source_dir, public_base, dest_base, url_base, ignore_patterns=None):
+def colabize_directory(source_dir, public_base, dest_base, url_base, ignore_patterns=None, cache_dir=None):
     source_dir = os.path.relpath(source_dir)
     assert not source_dir.startswith('..')
     public_dir = os.path.join(public_base, source_dir)
-    ignore = shutil.ignore_patterns('*.ipynb', *(IGNORE_PATTERNS if ignore_patterns is None else ignore_patterns))
-    shutil.copytree(source_dir, public_dir, ignore=ignore, dirs_exist_ok=True)
-
-    ignore = shutil.ignore_patterns(*IGNORE_PATTERNS)
-    for (dirpath, dirs, fnames) in os.walk(source_dir):
-        ignored_dirs = set(ignore(dirpath, dirs))
-        dirs[:] = filter(lambda x: x not in ignored_dirs, dirs)
-        ipynb_files = (x for x in fnames if x.endswith('.ipynb'))
-        dl_ignore_patterns = ['*.ipynb']
-        with contextlib.suppress(FileNotFoundError):
-            with open(os.path.join(dirpath, DOWNLOAD_IGNORE_FILE), encoding='utf-8') as f:
-                dl_ignore_patterns.extend(f.read().splitlines())
-        dl_ignore = shutil.ignore_patterns(*dl_ignore_patterns)
-        for filename in ipynb_files:
-            source_path = os.path.join(dirpath, filename)
-            with open(source_path, encoding='utf-8') as f:
-                ipynb = json.load(f)
+    files = scan_tree(source_dir, IGNORE_PATTERNS if ignore_patterns is None else ignore_patterns)
+    copy_public_files(files, source_dir, public_dir)
+
+    for notebook in files:
+        if not notebook.relpath.endswith('.ipynb'):
+            continue
+        reldir, filename = os.path.split(notebook.relpath)
+        dirpath = os.path.join(source_dir, reldir) if reldir else source_dir
+        source_path = os.path.join(dirpath, filename)
+        target_dir = os.path.join(public_dir, os.path.relpath(dirpath, source_dir))
+        download_files = list_download_files(files, reldir)
+        with open(source_path, 'rb') as f:
+            content = f.read()
+
+        def colabize():
+            ipynb = json.loads(content)
             ref_imgs = replace_img_links(ipynb['cells'], os.path.join(url_base, dirpath))
-            header = make_colab_header(os.path.join(public_dir, os.path.relpath(dirpath, source_dir)), public_base, url_base, ref_imgs, dl_ignore)
+            header = make_colab_header(target_dir, public_base, url_base, ref_imgs, download_files)
             if header['source']:
                 ipynb['cells'].insert(0, header)
-            os.makedirs(os.path.join(dest_base, dirpath), exist_ok=True)
-            with open(os.path.join(dest_base, source_path), 'w', encoding='utf-8', newline='\n') as f:
-                json.dump(ipynb, f, indent=1, ensure_ascii=False)
-                f.write('\n')
+            return dumps_ipynb(ipynb)
+
+        key = cache_key(source_digest(__file__), content,
+                        json.dumps([url_base, dirpath, os.path.relpath(target_dir, public_base), download_files]).encode('utf-8'))
+        colab_ipynb = cached(cache_dir, 'colab', key, colabize)
+        os.makedirs(os.path.join(dest_base, dirpath), exist_ok=True)
+        write_file(os.path.join(dest_base, source_path), colab_ipynb)
+    clear_scan_cache()
+
+
+def copy_public_files(files, source_dir, public_dir):
+    for f in files:
+        if f.relpath.endswith('.ipynb'):
+            continue
+        dest = os.path.join(public_dir, f.relpath)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        shutil.copy2(os.path.join(source_dir, f.relpath), dest)
+
+
+def list_download_files(files, reldir):
+    """
+    Return (directory relative to reldir, filename) of files to be downloaded for notebooks in reldir.
+    """
+    prefix = '' if reldir in ('', '.') else os.path.join(reldir, '')
+    download_files = []
+    for f in files:
+        if f.relpath.startswith(prefix) and not f.relpath.endswith('.ipynb') and not f.download_ignored:
+            subdir, fname = os.path.split(f.relpath[len(prefix):])
+            download_files.append((subdir or '.', fname))
+    return download_files
 
 
-def make_colab_header(target_dir, target_base, url_base, ref_imgs, ignore=None):
+def make_colab_header(target_dir, target_base, url_base, ref_imgs, download_files):
     code_lines = []
-    for path, dirs, fnames in os.walk(target_dir):
-        ignored_dirs = set(ignore(path, dirs) if ignore else [])
-        ignored_files = set(ignore(path, fnames) if ignore else [])
-        dirs[:] = filter(lambda x: x not in ignored_dirs, dirs)
-        fnames[:] = filter(lambda x: x not in ignored_files, fnames)
-        public_dir = os.path.relpath(path, target_base)
-        reldir = os.path.relpath(path, target_dir)
-        code_lines.extend(f'!wget -P {reldir} {os.path.join(url_base, public_dir, fname)}\n'
-                          for fname in fnames if os.path.relpath(os.path.join(reldir, fname)) not in ref_imgs)
+    for reldir, fname in download_files:
+        public_dir = os.path.relpath(os.path.join(target_dir, reldir), target_base)
+        if os.path.relpath(os.path.join(reldir, fname)) not in ref_imgs:
+            code_lines.append(f'!wget -P {reldir} {os.path.join(url_base, public_dir, fname)}\n')
     if code_lines:
         code_lines[-1] = code_lines[-1].rstrip()
         code_lines = HEADER_NOTICE.splitlines(True) + code_lines
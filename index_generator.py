@@ -7,16 +7,21 @@ import argparse
 import itertools
 import collections
 import html
+import shutil
+import unicodedata
 
 import markdown
 
-from ipynb_common import path_iter, markdown_to_ipynb
+from ipynb_common import path_iter, markdown_to_ipynb, write_ipynb, cache_key, source_digest, cached
 
 INDEX_NAME = 'index_of_terms'
 TITLE = '索引'
 
 MAX_HEADING_LEVEL = 3
 
+# Must agree with the loader in sphinx/_templates/term_search.html
+SHARD_PREFIX_LENGTH = 1
+
 
 def main():
     parser = argparse.ArgumentParser()
@@ -24,6 +29,8 @@ def main():
     parser.add_argument('-d', '--dest_dir', required=True, help='Specify a directory to place an index.')
     parser.add_argument('-n', '--name', default=INDEX_NAME, help=f'Specify the name of an index file (default: {INDEX_NAME}).')
     parser.add_argument('-y', '--yomi_dict', help='Specify a yomigana dictionary of indexed tems.')
+    parser.add_argument('-C', '--cache_dir', help='Specify a directory of the build cache shared among versions and builds on a host.')
+    parser.add_argument('-t', '--term_shards', metavar='DEST_DIR', help='Generate a JSON index of terms sharded by the prefix of their yomi into a specified directory.')
     commandline_args = parser.parse_args()
 
     assert os.path.isdir(commandline_args.source)
@@ -35,57 +42,75 @@ def main():
             yomi_dict = json.load(f)
     term_normalizer = make_lexicographical_normalizer(yomi_dict)
 
-    index = index_terms(path_iter(commandline_args.source))
+    index = index_terms(path_iter(commandline_args.source), cache_dir=commandline_args.cache_dir)
     ipynb = markdown_to_ipynb(convert_to_markdown_lines(index, commandline_args.dest_dir, sorting_key=term_normalizer))
-    with open(os.path.join(commandline_args.dest_dir, f'{commandline_args.name}.ipynb'), 'w', encoding='utf-8') as f:
-        json.dump(ipynb, f, indent=1, ensure_ascii=False)
-        f.write('\n')
+    write_ipynb(os.path.join(commandline_args.dest_dir, f'{commandline_args.name}.ipynb'), ipynb)
+    if commandline_args.term_shards is not None:
+        write_term_shards(index, commandline_args.dest_dir, commandline_args.term_shards, normalizer=term_normalizer)
 
 
-def index_terms(notebooks, *, heading_level=MAX_HEADING_LEVEL):
-    md2html = markdown.Markdown().convert
+def index_terms(notebooks, *, heading_level=MAX_HEADING_LEVEL, cache_dir=None):
     term_index = collections.defaultdict(list)
 
     for notebook in notebooks:
-        with open(notebook, encoding='utf_8') as f:
-            cells = json.load(f)['cells']
-        source = itertools.chain.from_iterable(cell['source'] for cell in cells if cell['cell_type'] == 'markdown')
-
-        headings = set()
-        current_heading = None
-        is_inside_code_block = False
-        for line in source:
-            # Skip code block
-            triple_backquote_count = line.count('```')
-            if triple_backquote_count > 0:
-                assert triple_backquote_count == 1, ('A code block is incorrectly escaped.', notebook, line)
-                is_inside_code_block = not is_inside_code_block
-            if is_inside_code_block:
-                continue
+        with open(notebook, 'rb') as f:
+            content = f.read()
+        key = cache_key(source_digest(__file__), str(heading_level).encode('utf-8'), content)
+        terms, collided_headings = json.loads(cached(cache_dir, 'terms', key,
+                                                     lambda: json.dumps(extract_terms(json.loads(content)['cells'], notebook, heading_level)).encode('utf-8')))
+        # Warnings are cached with terms so that they are shown on every build
+        for heading in collided_headings:
+            print(f'[WARNING] Heading `{heading}` collided in `{notebook}`.')
+        for term, heading in terms:
+            term_index[term].append((notebook, heading))
+
+    return term_index
 
-            # Update the heading of the current section
-            match_heading = re.match(r'\#+', line)
-            if match_heading is not None and len(match_heading[0]) <= heading_level:
-                current_heading = line.lstrip('#').strip()
-                if current_heading in headings:
-                    print(f'[WARNING] Heading `{current_heading}` collided in `{notebook}`.')
-                else:
-                    headings.add(current_heading)
 
-            # Collect indexed terms
-            for term in re.findall(r'<strong>(.*?)</strong>', md2html(line)):
-                # Exclude <strong><em>...</em></strong> (i.e., something enclosed by ***)
-                if term.startswith('<em>'):
-                    continue
+def extract_terms(cells, notebook, heading_level):
+    """
+    Return pairs of an indexed term and its heading, and headings appearing more than once.
+    """
+    md2html = markdown.Markdown().convert
+    source = itertools.chain.from_iterable(cell['source'] for cell in cells if cell['cell_type'] == 'markdown')
+
+    terms = []
+    collided_headings = []
+    headings = set()
+    current_heading = None
+    is_inside_code_block = False
+    for line in source:
+        # Skip code block
+        triple_backquote_count = line.count('```')
+        if triple_backquote_count > 0:
+            assert triple_backquote_count == 1, ('A code block is incorrectly escaped.', notebook, line)
+            is_inside_code_block = not is_inside_code_block
+        if is_inside_code_block:
+            continue
+
+        # Update the heading of the current section
+        match_heading = re.match(r'\#+', line)
+        if match_heading is not None and len(match_heading[0]) <= heading_level:
+            current_heading = line.lstrip('#').strip()
+            if current_heading in headings:
+                collided_headings.append(current_heading)
+            else:
+                headings.add(current_heading)
+
+        # Collect indexed terms
+        for term in re.findall(r'<strong>(.*?)</strong>', md2html(line)):
+            # Exclude <strong><em>...</em></strong> (i.e., something enclosed by ***)
+            if term.startswith('<em>'):
+                continue
 
-                term = re.sub(r'</?code>', '`', term)
-                # Remove function call parentheses
-                if term.endswith('()`'):
-                    term = term[:-len('()`')] + '`'
+            term = re.sub(r'</?code>', '`', term)
+            # Remove function call parentheses
+            if term.endswith('()`'):
+                term = term[:-len('()`')] + '`'
 
-                term_index[term].append((notebook, current_heading))
+            terms.append((term, current_heading))
 
-    return term_index
+    return (terms, collided_headings)
 
 
 def make_lexicographical_normalizer(yomi_dict):
@@ -130,26 +155,73 @@ def make_lexicographical_normalizer(yomi_dict):
     return normalize
 
 
+def search_key(s):
+    """
+    Normalize s for lookups in the term search, which applies the same rule to queries:
+    NFKC, without backquotes, hiragana (including small kana) into katakana, and lower case.
+    """
+    s = unicodedata.normalize('NFKC', s).replace('`', '')
+    return re.sub('[\u3041-\u3096]', lambda m: chr(ord(m[0]) + 0x60), s).lower()
+
+
 def convert_to_markdown_lines(index_terms, base_dir, *, title=TITLE, sorting_key=None):
     md2html = markdown.Markdown().convert
     lines = [f'# {title}\n', '\n']
     for term in sorted(index_terms, key=sorting_key):
         refs = []
         for notebook, heading in index_terms[term]:
-            notebook = os.path.relpath(notebook, base_dir)
-            # Remove strong from heading
-            for ref in re.findall(r'<strong>(.*?)</strong>',  md2html(heading)):
-                ref = re.sub(r'</?code>', '`', ref)
-                heading = heading.replace(f'**{ref}**', ref).replace(f'<strong>{ref}</strong>', ref)
-            # Create links
-            link = heading
-            for code in re.findall(r'<code>(.*?)</code>', md2html(link)):
-                link = link.replace(f'`{code}`', code)
-            link = re.sub(r'\s+', '-', link.strip())
+            notebook, heading, link = make_reference(notebook, heading, base_dir, md2html)
             refs.append(f'[{os.path.splitext(notebook)[0]}#{heading}]({notebook}#{link})')
         lines.append(f'- {html.unescape(term)} {", ".join(refs)}\n')
     return lines
 
 
+def write_term_shards(index_terms, base_dir, dest_dir, *, normalizer):
+    """
+    Write terms into JSON files named after the code points of the prefix of their search keys,
+    so that a page looks up a term by fetching only one small shard.
+    A term is found by its yomi and by its surface form, so it is written into the shards of both.
+    """
+    md2html = markdown.Markdown().convert
+    shards = collections.defaultdict(list)
+    for term in sorted(index_terms, key=normalizer):
+        surface = html.unescape(term).replace('`', '')
+        keys = list(dict.fromkeys((search_key(normalizer(term)), search_key(surface))))
+        refs = []
+        for notebook, heading in index_terms[term]:
+            notebook, heading, link = make_reference(notebook, heading, base_dir, md2html)
+            page = os.path.splitext(notebook)[0]
+            refs.append([f'{page}#{heading}', f'{page}.html#{link}'])
+        entry = {'keys': keys, 'term': surface, 'refs': refs}
+        for prefix in dict.fromkeys(key[:SHARD_PREFIX_LENGTH] for key in keys):
+            shards[prefix].append(entry)
+
+    shutil.rmtree(dest_dir, ignore_errors=True)
+    os.makedirs(dest_dir)
+    for prefix, entries in shards.items():
+        shard_name = '-'.join(f'{ord(c):x}' for c in prefix)
+        with open(os.path.join(dest_dir, f'{shard_name}.json'), 'w', encoding='utf-8') as f:
+            json.dump(entries, f, ensure_ascii=False, separators=(',', ':'))
+
+
+def make_reference(notebook, heading, base_dir, md2html):
+    notebook = os.path.relpath(notebook, base_dir)
+    heading, link = heading_anchor(heading, md2html)
+    return (notebook, heading, link)
+
+
+def heading_anchor(heading, md2html):
+    # Remove strong from heading
+    for ref in re.findall(r'<strong>(.*?)</strong>',  md2html(heading)):
+        ref = re.sub(r'</?code>', '`', ref)
+        heading = heading.replace(f'**{ref}**', ref).replace(f'<strong>{ref}</strong>', ref)
+    # Create links
+    link = heading
+    for code in re.findall(r'<code>(.*?)</code>', md2html(link)):
+        link = link.replace(f'`{code}`', code)
+    link = re.sub(r'\s+', '-', link.strip())
+    return (heading, link)
+
+
 if __name__ == '__main__':
     main()
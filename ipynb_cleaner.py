@@ -5,7 +5,7 @@ import sys
 import json
 import argparse
 
-from ipynb_common import path_iter, COMMON_METADATA
+from ipynb_common import path_iter, write_ipynb, COMMON_METADATA
 
 if (sys.version_info.major, sys.version_info.minor) < (3, 8):
     print('[ERROR] This script requires Python >= 3.8.')
@@ -33,9 +33,7 @@ def cleanup_ipynb(source, dest, preserved, interactive):
         ipynb = json.load(f)
     cleanup_metadata(ipynb['metadata'], os.path.basename(source), preserved, interactive)
     cleanup_cells(ipynb['cells'], os.path.basename(source), preserved, interactive)
-    with open(dest, 'w', encoding='utf-8', newline='\n') as f:
-        json.dump(ipynb, f, indent=1, ensure_ascii=False)
-        f.write('\n')
+    write_ipynb(dest, ipynb)
 
 
 def cleanup_metadata(metadata, notebook, preserved, interactive):
@@ -1,5 +1,18 @@
 import os
-import shutil
+import re
+import json
+import atexit
+import fnmatch
+import hashlib
+import functools
+import contextlib
+import collections
+from json.encoder import encode_basestring
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
 
 COMMON_METADATA = {
     'kernelspec': {
@@ -14,17 +27,100 @@ COMMON_METADATA = {
 
 IGNORE_PATTERNS = ('.*',)
 
+DOWNLOAD_IGNORE_FILE = '.download_ignore'
+
+ScannedFile = collections.namedtuple('ScannedFile', ('relpath', 'stat', 'download_ignored'))
+
+CACHE_LOCK_FILE = '.lock'
+CACHE_STATISTICS_FILE = '.statistics.json'
+
+# Hits and misses of this process keyed by (cache_dir, namespace, 'hits' or 'misses')
+cache_statistics = collections.Counter()
+
 
 def path_iter(base_dir, ignore_patterns=IGNORE_PATTERNS):
-    ignore = shutil.ignore_patterns(*ignore_patterns)
-    for (dirpath, dirs, fnames) in os.walk(base_dir):
-        ignored_dirs = set(ignore(dirpath, dirs))
-        ignored_files = set(ignore(dirpath, fnames))
-        dirs[:] = filter(lambda x: x not in ignored_dirs, dirs)
-        fnames[:] = filter(lambda x: x not in ignored_files, fnames)
-        for f in fnames:
-            if f.endswith('.ipynb'):
-                yield os.path.join(dirpath, f)
+    for f in scan_tree(base_dir, ignore_patterns):
+        if f.relpath.endswith('.ipynb'):
+            yield os.path.join(base_dir, f.relpath)
+
+
+def scan_tree(base_dir, ignore_patterns=IGNORE_PATTERNS):
+    """
+    Return files under base_dir not matching ignore_patterns as ScannedFile sorted by relpath.
+    The listing is cached until clear_scan_cache() is called by stages modifying the tree.
+    """
+    return scan_directory(os.path.abspath(base_dir), tuple(ignore_patterns))
+
+
+@functools.lru_cache(maxsize=None)
+def scan_directory(base_dir, ignore_patterns):
+    ignore = compile_patterns(ignore_patterns)
+    files = []
+
+    def scan(dirpath, reldir, download_ignores, download_ignored):
+        try:
+            entries = list(os.scandir(dirpath))
+        except OSError: # Like os.walk, errors (e.g., base_dir is not a directory) are ignored
+            return
+        # Patterns in DOWNLOAD_IGNORE_FILE apply to the directory and its subdirectories
+        try:
+            with open(os.path.join(dirpath, DOWNLOAD_IGNORE_FILE), encoding='utf-8') as f:
+                download_ignores = (*download_ignores, compile_patterns(tuple(f.read().splitlines())))
+        except FileNotFoundError:
+            pass
+        for entry in entries:
+            if ignore is not None and ignore.match(entry.name):
+                continue
+            relpath = os.path.join(reldir, entry.name)
+            ignored = download_ignored or any(p is not None and p.match(entry.name) for p in download_ignores)
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    scan(entry.path, relpath, download_ignores, ignored)
+            else:
+                files.append(ScannedFile(relpath, entry.stat(), ignored))
+
+    scan(base_dir, '', (), False)
+    files.sort()
+    return tuple(files)
+
+
+def scan_subtree(source_dir, ignore_patterns=IGNORE_PATTERNS):
+    """
+    Return scan_tree(source_dir, ignore_patterns), where DOWNLOAD_IGNORE_FILE in the ancestors of source_dir
+    up to the current directory also applies, without scanning anything outside of source_dir.
+    """
+    parts = [] if source_dir in ('', '.') else os.path.normpath(source_dir).split(os.sep)
+    download_ignores = []
+    ignored = False
+    for i, name in enumerate(parts):
+        try:
+            with open(os.path.join('.', *parts[:i], DOWNLOAD_IGNORE_FILE), encoding='utf-8') as f:
+                download_ignores.append(compile_patterns(tuple(f.read().splitlines())))
+        except FileNotFoundError:
+            pass
+        ignored = ignored or any(p is not None and p.match(name) for p in download_ignores)
+    files = scan_tree(source_dir, ignore_patterns)
+    if not ignored and all(p is None for p in download_ignores):
+        return files
+    return tuple(f._replace(download_ignored=True)
+                 if ignored or any(p is not None and p.match(name) for p in download_ignores for name in f.relpath.split(os.sep))
+                 else f
+                 for f in files)
+
+
+def clear_scan_cache():
+    scan_directory.cache_clear()
+
+
+@functools.lru_cache(maxsize=None)
+def compile_patterns(patterns):
+    """
+    Compile glob patterns into a single regular expression (None if no pattern is given).
+    """
+    patterns = [p for p in patterns if p]
+    if not patterns:
+        return None
+    return re.compile('|'.join(fnmatch.translate(p) for p in patterns))
 
 
 def markdown_to_ipynb(markdown_lines):
@@ -40,3 +136,205 @@ def markdown_to_ipynb(markdown_lines):
         'nbformat_minor': 4
     }
     return ipynb
+
+
+def dumps_ipynb(ipynb):
+    """
+    Return the same bytes as json.dump(ipynb, f, indent=1, ensure_ascii=False) followed by a newline.
+    The indent path of the json module is pure Python, so lines of cells are joined at once here instead.
+    """
+    chunks = []
+    append = chunks.append
+
+    def encode(o, indent):
+        if type(o) is str:
+            append(encode_basestring(o))
+        elif isinstance(o, (list, tuple)):
+            if not o:
+                append('[]')
+                return
+            inner = indent + ' '
+            separator = ',\n' + inner
+            if all(type(item) is str for item in o):
+                append(f'[\n{inner}{separator.join(map(encode_basestring, o))}\n{indent}]')
+                return
+            append('[\n' + inner)
+            for i, item in enumerate(o):
+                if i:
+                    append(separator)
+                encode(item, inner)
+            append(f'\n{indent}]')
+        elif isinstance(o, dict):
+            if not o:
+                append('{}')
+                return
+            inner = indent + ' '
+            separator = ',\n' + inner
+            append('{\n' + inner)
+            for i, (key, value) in enumerate(o.items()):
+                if i:
+                    append(separator)
+                append(encode_basestring(key if type(key) is str else encode_key(key)) + ': ')
+                encode(value, inner)
+            append(f'\n{indent}}}')
+        else:
+            append(encode_scalar(o))
+
+    encode(ipynb, '')
+    append('\n')
+    return ''.join(chunks).encode('utf-8')
+
+
+def encode_scalar(o):
+    if isinstance(o, str):
+        return encode_basestring(o)
+    if o is None:
+        return 'null'
+    if o is True:
+        return 'true'
+    if o is False:
+        return 'false'
+    if isinstance(o, int):
+        return int.__repr__(o)
+    if isinstance(o, float):
+        if o != o:
+            return 'NaN'
+        if o in (float('inf'), float('-inf')):
+            return 'Infinity' if o > 0 else '-Infinity'
+        return float.__repr__(o)
+    raise TypeError(f'Object of type {type(o).__name__} is not JSON serializable')
+
+
+def encode_key(key):
+    if isinstance(key, str):
+        return key
+    if isinstance(key, (int, float)) or key is None:
+        return encode_scalar(key)
+    raise TypeError(f'keys must be str, int, float, bool or None, not {type(key).__name__}')
+
+
+def write_ipynb(path, ipynb):
+    return write_file(path, dumps_ipynb(ipynb))
+
+
+def write_file(path, data):
+    """
+    Write bytes atomically, leaving the file untouched if it already has the same bytes.
+    Return whether the file was written.
+    """
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == data:
+                return False
+    except FileNotFoundError:
+        pass
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return True
+
+
+def cache_key(*contents):
+    digest = hashlib.sha256()
+    for content in contents:
+        digest.update(hashlib.sha256(content).digest())
+    return digest.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def source_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).digest()
+
+
+def cached(cache_dir, namespace, key, generate):
+    """
+    Return the bytes made by generate() through a content-addressed cache.
+    Entries are shared by every build using the same cache_dir (e.g., versions of a document or CI jobs on a host).
+    """
+    if cache_dir is None:
+        return generate()
+    path = os.path.join(cache_dir, namespace, key[:2], key)
+    try:
+        with cache_lock(cache_dir):
+            with open(path, 'rb') as f:
+                data = f.read()
+            # Refresh the last use for LRU eviction
+            os.utime(path)
+        cache_statistics[(cache_dir, namespace, 'hits')] += 1
+        return data
+    except FileNotFoundError:
+        pass
+    cache_statistics[(cache_dir, namespace, 'misses')] += 1
+    data = generate()
+    with cache_lock(cache_dir):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    return data
+
+
+@contextlib.contextmanager
+def cache_lock(cache_dir, exclusive=False):
+    """
+    Entries are read and written under a shared lock, which eviction excludes.
+    Concurrent writers of an entry do not conflict since each renames its own temporary file.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, CACHE_LOCK_FILE), 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+
+
+def evict_cache(cache_dir, max_size):
+    """
+    Remove least recently used entries until the total size is within max_size bytes.
+    Return the number of removed entries, the removed bytes, and the remaining bytes.
+    """
+    with cache_lock(cache_dir, exclusive=True):
+        entries = []
+        for dirpath, _, fnames in os.walk(cache_dir):
+            if dirpath == cache_dir:
+                continue
+            for fname in fnames:
+                path = os.path.join(dirpath, fname)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total_size = sum(size for _, size, _ in entries)
+        removed_count, removed_size = 0, 0
+        for _, size, path in sorted(entries):
+            if total_size <= max_size:
+                break
+            os.remove(path)
+            total_size -= size
+            removed_count += 1
+            removed_size += size
+    return (removed_count, removed_size, total_size)
+
+
+def load_cache_statistics(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, CACHE_STATISTICS_FILE), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+@atexit.register
+def save_cache_statistics():
+    cache_dirs = set(cache_dir for cache_dir, _, _ in cache_statistics)
+    for cache_dir in cache_dirs:
+        with cache_lock(cache_dir, exclusive=True):
+            statistics = load_cache_statistics(cache_dir)
+            for (d, namespace, event), count in cache_statistics.items():
+                if d == cache_dir:
+                    counts = statistics.setdefault(namespace, {'hits': 0, 'misses': 0})
+                    counts[event] += count
+            # Replaced atomically since readers of the statistics do not take the lock
+            write_file(os.path.join(cache_dir, CACHE_STATISTICS_FILE),
+                       (json.dumps(statistics, indent=1, sort_keys=True) + '\n').encode('utf-8'))
+    cache_statistics.clear()
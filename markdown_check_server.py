@@ -0,0 +1,110 @@
+#! /usr/bin/env python3
+
+import sys
+import json
+import time
+
+from markdown_checker import check_html_tag, check_lists, check_spacing_around_code
+
+CHECKS = (check_html_tag, check_lists, check_spacing_around_code)
+
+
+def main():
+    """
+    Check Markdown cells incrementally for editors, reading a JSON request per line from stdin
+    and writing a JSON response per line to stdout.
+
+    Requests:
+      {"id": ..., "method": "check", "notebook": NAME, "cells": [CELL, ...]}
+          where CELL is {"cell_type": ..., "source": str or [str, ...]} (i.e., cells of ipynb).
+      {"id": ..., "method": "close", "notebook": NAME}
+      {"id": ..., "method": "shutdown"}
+    Response to check:
+      {"id": ..., "diagnostics": [{"cell": INDEX, "line": LINE, "message": ..., "text": ...}, ...],
+       "checked_cells": N, "elapsed_ms": ...}
+    """
+    results = {}
+    for request_line in sys.stdin:
+        if not request_line.strip():
+            continue
+        try:
+            request = json.loads(request_line)
+        except ValueError as e:
+            response = {'id': None, 'error': f'{type(e).__name__}: {e}'}
+        else:
+            try:
+                response = handle_request(request, results)
+            except Exception as e:
+                response = {'id': request.get('id') if isinstance(request, dict) else None, 'error': f'{type(e).__name__}: {e}'}
+        print(json.dumps(response, ensure_ascii=False), flush=True)
+        if response.get('shutdown'):
+            break
+
+
+def handle_request(request, results):
+    method = request.get('method')
+    if method == 'check':
+        start = time.perf_counter()
+        diagnostics, checked_cells = check_notebook(request['cells'], results.setdefault(request['notebook'], {}))
+        return {'id': request.get('id'),
+                'diagnostics': diagnostics,
+                'checked_cells': checked_cells,
+                'elapsed_ms': (time.perf_counter() - start) * 1000}
+    if method == 'close':
+        results.pop(request['notebook'], None)
+        return {'id': request.get('id')}
+    if method == 'shutdown':
+        return {'id': request.get('id'), 'shutdown': True}
+    raise ValueError(f'Unknown method `{method}`.')
+
+
+def check_notebook(cells, cell_results):
+    """
+    Return diagnostics of cells and the number of cells actually checked.
+    cell_results maps the source of a cell to its diagnostics, so only cells whose source changed are checked.
+    """
+    diagnostics = []
+    sources = set()
+    checked_cells = 0
+    for index, cell in enumerate(cells):
+        if cell['cell_type'] != 'markdown':
+            continue
+        source = ''.join(cell['source'])
+        sources.add(source)
+        if source not in cell_results:
+            cell_results[source] = check_cell(source)
+            checked_cells += 1
+        diagnostics.extend(dict(d, cell=index) for d in cell_results[source])
+    # Forget cells no longer in the notebook
+    for source in cell_results.keys() - sources:
+        del cell_results[source]
+    return (diagnostics, checked_cells)
+
+
+def check_cell(source):
+    line_numbers, md_text = [], []
+    for line_number, line in extract_markdown_lines(source):
+        line_numbers.append(line_number)
+        md_text.append(line)
+    diagnostics = []
+    for check in CHECKS:
+        diagnostics.extend({'line': line_numbers[i], 'message': message, 'text': line.rstrip('\n')}
+                           for i, message, line in check(md_text))
+    diagnostics.sort(key=lambda d: d['line'])
+    return diagnostics
+
+
+def extract_markdown_lines(source):
+    is_inside_code_block = False
+    for line_number, line in enumerate(source.splitlines(keepends=True)):
+        # Skip code block
+        if line.count('```') > 0:
+            is_inside_code_block = not is_inside_code_block
+            continue
+        if is_inside_code_block:
+            continue
+        yield (line_number, line if line.endswith('\n') else line + '\n')
+
+
+if __name__ == '__main__':
+    main()
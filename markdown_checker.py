@@ -5,33 +5,40 @@ import re
 import sys
 import json
 import itertools
-import contextlib
 
 import markdown
 
 from ipynb_common import path_iter
 
 
+markdown_converter = markdown.Markdown()
+
+
+def md2html(md_text):
+    # Reset the state (e.g., stashed raw HTML and reference definitions) left by the previous conversion,
+    # since the instance lives as long as the process (e.g., markdown_check_server.py)
+    return markdown_converter.reset().convert(md_text)
+
+
 def main():
     for base in sys.argv[1:]:
         for path in path_iter(base):
             with open(path, encoding='utf-8') as f:
                 ipynb = json.load(f)
             nb = os.path.basename(path)
-            check_html_tag(extract_markdowns(ipynb), nb)
-            check_lists(extract_markdowns(ipynb), nb)
-            check_spacing_around_code(extract_markdowns(ipynb), nb)
+            for check in (check_html_tag, check_lists, check_spacing_around_code):
+                for _, message, line in check(extract_markdowns(ipynb)):
+                    print(message, nb, line, sep=' | ', end='')
 
 
-def check_lists(md_text, notebook):
+def check_lists(md_text):
     """
-    Print warnings of lists in a style problematic for nbsphinx.
+    Yield warnings of lists in a style problematic for nbsphinx as (index of line, message, line).
     False positives are due to line-wise checking.
     """
-    md2html = markdown.Markdown().convert
     is_next_of_blank = True
     is_next_of_item = False
-    for line in md_text:
+    for i, line in enumerate(md_text):
         if line.strip() == '':
             is_next_of_blank = True
             is_next_of_item =  False
@@ -39,34 +46,34 @@ def check_lists(md_text, notebook):
             htmlline = md2html(line)
             match_heading = re.match(r'(<ul>\s*?<li>.*?</li>\s*?</ul>)|(<ol>\s*?<li>.*?</li>\s*?</ol>)', htmlline)
             if match_heading is not None and not is_next_of_blank and not is_next_of_item:
-                print('[ILL-STYLED] No blank before lists in Markdown.', notebook, line, sep=' | ', end='')
+                yield (i, '[ILL-STYLED] No blank before lists in Markdown.', line)
             is_next_of_blank = False
             is_next_of_item = match_heading is not None or is_next_of_item
 
 
-def check_html_tag(md_text, notebook):
-    for line in md_text:
+def check_html_tag(md_text):
+    for i, line in enumerate(md_text):
         m = re.search('(<[a-zA-Z]+>)', line)
         if m is not None and m[1] != '<strong>':
-            print(f'[ILL-STYLED] {m[1]} exists.', notebook, line, sep=' | ', end='')
+            yield (i, f'[ILL-STYLED] {m[1]} exists.', line)
 
 
-def check_spacing_around_code(md_text, notebook):
+def check_spacing_around_code(md_text):
     """
-    Print warnings of spacing around code.
+    Yield warnings of spacing around code as (index of line, message, line).
     It is according to general rules in Japanese text (i.e., Kinsoku Shori).
     """
-    for line in md_text:
+    for i, line in enumerate(md_text):
         m = re.search(r'```', line)
         if m is not None:
             if not line.startswith('```'):
-                print('[ILL-STYLED] ``` appears not at BOL.', notebook, line, sep=' | ', end='')
+                yield (i, '[ILL-STYLED] ``` appears not at BOL.', line)
             continue
 
         starter = [' ', '　', '。', '、', '）', ')', '（', '(', '・',  '：', '「', '#', '[']
         closer = [' ', '\n', '。', '、', '（', '）', ')', ',', '・', '」', ']']
         terms = set()
-        with contextlib.suppress(StopIteration):
+        try:
             for code_pat in (r'\*\*`(.*?)`\*\*', r'<strong>`(.*?)`</strong>', r'`(.*?)`'):
                 for m in re.finditer(code_pat, line):
                     if m[1] in terms:
@@ -74,8 +81,9 @@ def check_spacing_around_code(md_text, notebook):
                     terms.add(m[1])
                     if not any(line.startswith(m[0] + suf) for suf in closer) and \
                        not any(pre + m[0] + suf in line for pre in starter for suf in closer):
-                        print('[ILL-STYLED] Spacing around code is inappropriate.', notebook, line, sep=' | ', end='')
                         raise StopIteration
+        except StopIteration:
+            yield (i, '[ILL-STYLED] Spacing around code is inappropriate.', line)
 
 
 def extract_markdowns(ipynb):
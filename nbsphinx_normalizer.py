@@ -2,32 +2,177 @@
 
 import os
 import re
+import io
 import sys
 import json
+import base64
+import hashlib
+import zipfile
 import argparse
 
 import markdown
 
+from ipynb_common import cache_key, source_digest, cached, dumps_ipynb, write_file, scan_tree, clear_scan_cache
+
+OUTPUTS_DIR = '_outputs'
+EXECUTED_NOTEBOOK = 'executed.ipynb'
+EXECUTION_OUTPUTS_DIR = 'files'
+EXTRACTED_MIME_TYPES = {
+    'image/png': '.png',
+    'image/jpeg': '.jpg',
+    'image/gif': '.gif',
+}
+EXTRACTION_THRESHOLD = 16 * 1024
+BASE64_CHUNK_SIZE = 64 * 1024 # Must be a multiple of 4
+
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-s', '--source', nargs='*', required=True, default=[], help='Specify source ipynb file(s).')
     parser.add_argument('-d', '--dest_dir', default='.', help=f'Specify a directory to place output (default: the current directory).')
+    parser.add_argument('-e', '--extract_outputs', nargs='?', type=int, const=EXTRACTION_THRESHOLD, metavar='THRESHOLD', help=f'Extract base64 image outputs larger than THRESHOLD bytes (default: {EXTRACTION_THRESHOLD}) into {OUTPUTS_DIR} of the destination.')
     commandline_args = parser.parse_args()
     
     assert os.path.isdir(commandline_args.dest_dir)
+    outputs_dir = None
+    if commandline_args.extract_outputs is not None:
+        outputs_dir = os.path.join(commandline_args.dest_dir, OUTPUTS_DIR)
     for source in commandline_args.source:
         assert commandline_args.source.endswith('.ipynb')
-        sanitize_ipynb(source, os.path.join(commandline_args.dest_dir, source))
-
-
-def sanitize_ipynb(source, dest):
-    with open(source, encoding='utf-8') as f:
-        ipynb = json.load(f)
-    ipynb['cells'] = [sanitize_cell(x) for x in ipynb['cells']]
-    with open(dest, 'w', encoding='utf-8', newline='\n') as f:
-        json.dump(ipynb, f, indent=1, ensure_ascii=False)
-        f.write('\n')
+        sanitize_ipynb(source, os.path.join(commandline_args.dest_dir, source),
+                       outputs_dir=outputs_dir, threshold=commandline_args.extract_outputs)
+
+
+def sanitize_ipynb(source, dest, cache_dir=None, outputs_dir=None, threshold=EXTRACTION_THRESHOLD, execution_root=None, execution_context=b''):
+    """
+    Write source sanitized for nbsphinx into dest.
+    If execution_root (the root of the destination tree) is given, notebooks which nbsphinx would execute are executed here
+    through the build cache, where execution_context identifies what they may read (cf. tree_digest()).
+    """
+    with open(source, 'rb') as f:
+        content = f.read()
+
+    def sanitize():
+        ipynb = json.loads(content)
+        ipynb['cells'] = [sanitize_cell(x) for x in ipynb['cells']]
+        return dumps_ipynb(ipynb)
+
+    sanitized = cached(cache_dir, 'sanitized', cache_key(source_digest(__file__), content), sanitize)
+    if execution_root is not None and will_be_executed(json.loads(sanitized)):
+        sanitized = execute_cached(sanitized, os.path.dirname(dest) or '.', execution_root, execution_context, cache_dir)
+    if outputs_dir is not None:
+        # Extracted files must exist on every build, so this is done outside of the cache
+        ipynb = json.loads(sanitized)
+        if extract_outputs(ipynb['cells'], os.path.dirname(dest), outputs_dir, threshold):
+            sanitized = dumps_ipynb(ipynb)
+    write_file(dest, sanitized)
+
+
+def will_be_executed(ipynb):
+    """
+    Return whether nbsphinx executes the notebook with nbsphinx_execute = 'auto' (i.e., it has no outputs).
+    """
+    if ipynb['metadata'].get('nbsphinx', {}).get('execute') == 'never':
+        return False
+    return not any(cell['cell_type'] == 'code' and cell['outputs'] for cell in ipynb['cells'])
+
+
+def execute_cached(content, notebook_dir, root_dir, context, cache_dir):
+    """
+    Return the executed notebook through the build cache, restoring files written under root_dir by the execution on a hit.
+    """
+    key = cache_key(source_digest(__file__), content, context)
+    archive = cached(cache_dir, 'executed', key, lambda: execute_ipynb(content, notebook_dir, root_dir))
+    with zipfile.ZipFile(io.BytesIO(archive)) as zipf:
+        for name in zipf.namelist():
+            if name.startswith(EXECUTION_OUTPUTS_DIR + '/'):
+                path = os.path.join(root_dir, *name.split('/')[1:])
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                write_file(path, zipf.read(name))
+        return zipf.read(EXECUTED_NOTEBOOK)
+
+
+def execute_ipynb(content, notebook_dir, root_dir):
+    """
+    Execute a notebook in notebook_dir as nbsphinx would, and mark it so that nbsphinx does not execute it again.
+    Return a zip archive of the executed notebook and the files the execution wrote under root_dir.
+    """
+    # nbconvert comes with nbsphinx and is needed only by builds executing notebooks
+    import nbformat
+    from nbconvert.preprocessors import ExecutePreprocessor
+
+    before = tree_state(root_dir)
+    ipynb = nbformat.reads(content.decode('utf-8'), as_version=4)
+    # Errors are allowed as nbsphinx_allow_errors in sphinx/conf.py
+    ExecutePreprocessor(allow_errors=True, timeout=None).preprocess(ipynb, {'metadata': {'path': notebook_dir}})
+    ipynb.metadata['nbsphinx'] = dict(ipynb.metadata.get('nbsphinx', {}), execute='never')
+    written = sorted(relpath for relpath, state in tree_state(root_dir).items() if before.get(relpath) != state)
+
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as zipf:
+        zipf.writestr(EXECUTED_NOTEBOOK, dumps_ipynb(ipynb))
+        for relpath in written:
+            zipf.write(os.path.join(root_dir, relpath), '/'.join((EXECUTION_OUTPUTS_DIR, *relpath.split(os.sep))))
+    return archive.getvalue()
+
+
+def tree_state(base_dir):
+    clear_scan_cache()
+    return {f.relpath: (f.stat.st_size, f.stat.st_mtime_ns) for f in scan_tree(base_dir)}
+
+
+def tree_digest(base_dir, files):
+    """
+    Return a digest of paths and contents of files (ScannedFile under base_dir) other than notebooks,
+    any of which executed notebooks may read.
+    """
+    return cache_key(*(x for f in files if not f.relpath.endswith('.ipynb')
+                       for x in (f.relpath.encode('utf-8'), source_digest(os.path.join(base_dir, f.relpath))))).encode('utf-8')
+
+
+def extract_outputs(cells, notebook_dir, outputs_dir, threshold):
+    """
+    Replace large base64 image outputs with Markdown references to content-hashed files in outputs_dir.
+    Identical payloads (e.g., in different notebooks sharing outputs_dir) are stored only once.
+    """
+    extracted = False
+    for cell in cells:
+        if cell['cell_type'] != 'code':
+            continue
+        for output in cell['outputs']:
+            data = output.get('data', {})
+            for mime_type, extension in EXTRACTED_MIME_TYPES.items():
+                if mime_type not in data or 'text/markdown' in data:
+                    continue
+                payload = data[mime_type]
+                payload = ''.join(payload) if isinstance(payload, list) else payload
+                if len(payload) < threshold:
+                    continue
+                path = os.path.relpath(write_payload(payload, outputs_dir, extension), notebook_dir)
+                # Unique alt text of img: Cf. https://github.com/spatialaudio/nbsphinx/issues/162
+                alt_text = path.replace('-', '--').replace('_', '-')
+                del data[mime_type]
+                data['text/markdown'] = f'![{alt_text}]({path})'
+                extracted = True
+    return extracted
+
+
+def write_payload(payload, outputs_dir, extension):
+    payload = payload.replace('\n', '')
+    digest = hashlib.sha256()
+    os.makedirs(outputs_dir, exist_ok=True)
+    tmp_path = os.path.join(outputs_dir, f'.{os.getpid()}.tmp')
+    with open(tmp_path, 'wb') as f:
+        for i in range(0, len(payload), BASE64_CHUNK_SIZE):
+            chunk = base64.b64decode(payload[i:i + BASE64_CHUNK_SIZE])
+            digest.update(chunk)
+            f.write(chunk)
+    path = os.path.join(outputs_dir, digest.hexdigest() + extension)
+    if os.path.exists(path):
+        os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, path)
+    return path
 
 
 def sanitize_cell(cell):
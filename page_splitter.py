@@ -0,0 +1,179 @@
+#! /usr/bin/env python3
+
+import os
+import re
+import json
+import argparse
+import itertools
+
+import markdown
+
+from ipynb_common import path_iter, write_ipynb, clear_scan_cache
+from index_generator import heading_anchor
+from nbsphinx_normalizer import will_be_executed
+
+MAX_CELLS = 200
+MAX_BYTES = 1024 * 1024
+
+SPLIT_HEADING = re.compile(r'##(?!#)')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--source', required=True, help='Specify a source directory.')
+    parser.add_argument('-c', '--max_cells', type=int, default=MAX_CELLS, help=f'Split notebooks with more cells than this (default: {MAX_CELLS}).')
+    parser.add_argument('-b', '--max_bytes', type=int, default=MAX_BYTES, help=f'Split notebooks larger than this in bytes (default: {MAX_BYTES}).')
+    parser.add_argument('-t', '--term_index', help='Specify a directory of term index shards written by index_generator.py to redirect their links.')
+    commandline_args = parser.parse_args()
+
+    assert os.path.isdir(commandline_args.source)
+    split_directory(commandline_args.source, commandline_args.max_cells, commandline_args.max_bytes, commandline_args.term_index)
+
+
+def split_directory(base_dir, max_cells=MAX_CELLS, max_bytes=MAX_BYTES, term_index_dir=None):
+    """
+    Split oversized notebooks in base_dir into pages at level-2 headings,
+    and redirect links to the headings in every notebook (and in term index shards) to their new pages.
+    """
+    pages = {}
+    for notebook in list(path_iter(base_dir)):
+        pages.update(split_ipynb(notebook, max_cells, max_bytes))
+    clear_scan_cache()
+    if pages:
+        for notebook in path_iter(base_dir):
+            rewrite_links(notebook, pages)
+        if term_index_dir is not None:
+            rewrite_term_shards(term_index_dir, base_dir, pages)
+    return pages
+
+
+def split_ipynb(notebook, max_cells, max_bytes):
+    """
+    Return {(notebook, anchor): page} for the headings of notebook if it is split into pages.
+    The first page stays at the path of notebook and gets a toctree of the others.
+    """
+    with open(notebook, 'rb') as f:
+        content = f.read()
+    ipynb = json.loads(content)
+    if len(ipynb['cells']) <= max_cells and len(content) <= max_bytes:
+        return {}
+    parts = [x for x in split_cells(ipynb['cells']) if x]
+    if len(parts) <= 1:
+        return {}
+    if will_be_executed(ipynb):
+        # Pages would be executed separately, each needing the code of all the preceding pages
+        print(f'[INFO] `{notebook}` is not split since nbsphinx executes it (execute it beforehand with release.py -E).')
+        return {}
+
+    notebook = os.path.normpath(notebook)
+    stem = os.path.splitext(notebook)[0]
+    paths = [notebook] + [f'{stem}-{i}.ipynb' for i in range(1, len(parts))]
+    md2html = markdown.Markdown().convert
+
+    pages = {}
+    for i, (cells, path) in enumerate(zip(parts, paths)):
+        pages.update(((notebook, anchor), path) for anchor in extract_anchors(cells, md2html))
+        if i == 0:
+            cells = cells + [{
+                'cell_type': 'markdown',
+                'metadata': {'nbsphinx-toctree': {}},
+                'source': [f'- [{os.path.basename(x)}]({os.path.basename(x)})\n' for x in paths[1:]],
+            }]
+        write_ipynb(path, dict(ipynb, cells=cells))
+    print(f'[INFO] `{notebook}` is split into {len(paths)} pages.')
+    return pages
+
+
+def split_cells(cells):
+    parts = [[]]
+    for cell in cells:
+        if cell['cell_type'] != 'markdown':
+            parts[-1].append(cell)
+            continue
+        chunks = [[]]
+        is_inside_code_block = False
+        for line in ''.join(cell['source']).splitlines(keepends=True):
+            # Skip code block
+            if line.count('```') > 0:
+                is_inside_code_block = not is_inside_code_block
+            if not is_inside_code_block and SPLIT_HEADING.match(line) is not None:
+                chunks.append([])
+            chunks[-1].append(line)
+        for i, chunk in enumerate(chunks):
+            if i > 0:
+                parts.append([])
+            if chunk:
+                piece = dict(cell, source=chunk)
+                if i > 0 and 'id' in cell:
+                    piece['id'] = f'{cell["id"]}-{i}'
+                parts[-1].append(piece)
+    return parts
+
+
+def extract_anchors(cells, md2html):
+    for cell in cells:
+        if cell['cell_type'] != 'markdown':
+            continue
+        is_inside_code_block = False
+        for line in ''.join(cell['source']).splitlines():
+            # Skip code block
+            if line.count('```') > 0:
+                is_inside_code_block = not is_inside_code_block
+            if not is_inside_code_block and line.startswith('#'):
+                yield heading_anchor(line.lstrip('#').strip(), md2html)[1]
+
+
+def rewrite_links(notebook, pages):
+    base_dir = os.path.dirname(notebook)
+    notebook = os.path.normpath(notebook)
+    origins = {page: origin for (origin, _), page in pages.items()}
+    origin = origins.get(notebook, notebook)
+
+    def redirect(m):
+        target = os.path.normpath(os.path.join(base_dir, m[1])) if m[1] else origin
+        page = pages.get((target, m[2]))
+        if page is None or page == (target if m[1] else notebook):
+            return m[0]
+        return f']({os.path.relpath(page, base_dir)}#{m[2]})'
+
+    with open(notebook, encoding='utf-8') as f:
+        ipynb = json.load(f)
+    rewritten = False
+    for cell in ipynb['cells']:
+        if cell['cell_type'] != 'markdown':
+            continue
+        source = ''.join(cell['source'])
+        redirected = re.sub(r'\]\(((?:[^()\s#]+\.ipynb)?)#([^()\s]+)\)', redirect, source)
+        if redirected != source:
+            cell['source'] = redirected.splitlines(keepends=True)
+            rewritten = True
+    if rewritten:
+        write_ipynb(notebook, ipynb)
+
+
+def rewrite_term_shards(term_index_dir, base_dir, pages):
+    """
+    Redirect references of term index shards, which are relative to the root of the source (i.e., base_dir), to split pages.
+    """
+    for entry in os.scandir(term_index_dir):
+        if not entry.name.endswith('.json'):
+            continue
+        with open(entry.path, encoding='utf-8') as f:
+            entries = json.load(f)
+        rewritten = False
+        for ref in itertools.chain.from_iterable(e['refs'] for e in entries):
+            label, link = ref
+            origin, anchor = link.split('#', 1)
+            page = pages.get((os.path.normpath(os.path.join(base_dir, os.path.splitext(origin)[0] + '.ipynb')), anchor))
+            if page is None:
+                continue
+            page = os.path.splitext(os.path.relpath(page, base_dir))[0]
+            ref[:] = [f'{page}#{label.split("#", 1)[1]}', f'{page}.html#{anchor}']
+            rewritten = True
+        if rewritten:
+            with open(entry.path, 'w', encoding='utf-8') as f:
+                json.dump(entries, f, ensure_ascii=False, separators=(',', ':'))
+
+
+if __name__ == '__main__':
+    main()
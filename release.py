@@ -4,11 +4,20 @@ import argparse
 import os
 import zipfile
 import shutil
+import filecmp
+import itertools
+import gzip
+import json
 
-from nbsphinx_normalizer import sanitize_ipynb
+from nbsphinx_normalizer import sanitize_ipynb, tree_digest, OUTPUTS_DIR, EXTRACTION_THRESHOLD
 from colabizer import colabize_directory
+from ipynb_common import scan_tree, clear_scan_cache
+from page_splitter import split_directory, MAX_CELLS, MAX_BYTES
 
 IGNORE_PATTERNS = ( '.*', '*~', '__pycache__')
+DEPLOY_IGNORE_PATTERNS = ('.git',)
+COMPRESSIBLE_EXTENSIONS = ('.html', '.js', '.css', '.svg', '.json', '.txt', '.xml')
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
 
 
 def main():
@@ -18,6 +27,13 @@ def main():
     parser.add_argument('-r', '--repository', default='.', help=f'Specify a path to a local repository to host Colab notebooks (default: the current directory).')
     parser.add_argument('-g', '--github', metavar=('usrename', 'reponame', 'branch', 'colab_dir'), nargs=4, help=f'Specify the information of GitHub repository (default: the current directory).')
     parser.add_argument('-x', '--nbsphinx', metavar='DEST_DIR', help=f'Generate source for nbsphinx to specified destination.')
+    parser.add_argument('-e', '--extract_outputs', nargs='?', type=int, const=EXTRACTION_THRESHOLD, metavar='THRESHOLD', help=f'Extract base64 image outputs larger than THRESHOLD bytes (default: {EXTRACTION_THRESHOLD}) from the source for nbsphinx into {OUTPUTS_DIR}.')
+    parser.add_argument('-p', '--split_pages', nargs=2, type=int, metavar=('MAX_CELLS', 'MAX_BYTES'), help=f'Split notebooks with more than MAX_CELLS cells or MAX_BYTES bytes into pages at level-2 headings in the source for nbsphinx (e.g., {MAX_CELLS} {MAX_BYTES}).')
+    parser.add_argument('-t', '--term_index', metavar='DIR', help=f'Specify a directory of term index shards whose links are redirected to pages split by -p.')
+    parser.add_argument('-E', '--execute', action='store_true', help=f'Execute notebooks without outputs in the source for nbsphinx beforehand through the build cache, so that nbsphinx does not execute them.')
+    parser.add_argument('-C', '--cache_dir', help=f'Specify a directory of the build cache shared among versions and builds on a host.')
+    parser.add_argument('-c', '--compress', action='store_true', help=f'Write gzipped siblings of compressible files and minify notebooks in the source directory before deployment.')
+    parser.add_argument('-d', '--deploy', metavar='DEST_DIR', help=f'Deploy the source directory into a specified destination, writing only added or changed files and deleting removed ones.')
     commandline_args = parser.parse_args()
 
     assert os.path.exists(commandline_args.source)
@@ -25,46 +41,135 @@ def main():
     if commandline_args.zip is not None:
         generate_zip(commandline_args.source, commandline_args.zip)
     if commandline_args.github is not None:
-        generate_colab(commandline_args.source, commandline_args.repository, *commandline_args.github)
+        generate_colab(commandline_args.source, commandline_args.repository, *commandline_args.github, cache_dir=commandline_args.cache_dir)
     if commandline_args.nbsphinx is not None:
-        generate_nbsphinx_src(commandline_args.source, commandline_args.nbsphinx)
+        generate_nbsphinx_src(commandline_args.source, commandline_args.nbsphinx, commandline_args.cache_dir, commandline_args.extract_outputs, commandline_args.split_pages, commandline_args.execute, commandline_args.term_index)
+    if commandline_args.compress:
+        compress_directory(commandline_args.source)
+    if commandline_args.deploy is not None:
+        deploy_directory(commandline_args.source, commandline_args.deploy)
 
 
 def generate_zip(source_dir, dest):
     source_dir = os.path.relpath(source_dir)
-    ignore = shutil.ignore_patterns(*IGNORE_PATTERNS)
     with zipfile.ZipFile(dest, 'w') as zipf:
-        for (dirpath, dirs, fnames) in os.walk(source_dir):
-            ignored_dirs = set(ignore(dirpath, dirs))
-            ignored_files = set(ignore(dirpath, fnames))
-            dirs[:] = filter(lambda x: x not in ignored_dirs, dirs)
-            fnames[:] = filter(lambda x: x not in ignored_files, fnames)
-            for f in fnames:
-                fullpath = os.path.join(dirpath, f)
-                zipf.write(fullpath, os.path.relpath(fullpath, source_dir))
+        for f in scan_tree(source_dir, IGNORE_PATTERNS):
+            path = os.path.join(source_dir, f.relpath)
+            # Fix timestamps so that regenerated but unchanged files yield an identical archive for differential deployment
+            info = zipfile.ZipInfo.from_file(path, f.relpath)
+            info.date_time = ZIP_DATE_TIME
+            with open(path, 'rb') as member:
+                zipf.writestr(info, member.read())
 
         print(f'{zipf.filename} archived:')
         for fn in zipf.namelist():
             print('  -', fn)
 
 
-def generate_colab(source_dir, repo_dir, github_username, github_reponame, github_branch, colab_dir):
+def generate_colab(source_dir, repo_dir, github_username, github_reponame, github_branch, colab_dir, *, cache_dir=None):
     url_base = f'https://raw.githubusercontent.com/{github_username}/{github_reponame}/{github_branch}/{colab_dir}'
     dest_base = os.path.relpath(os.path.join(repo_dir, colab_dir), source_dir)
+    if cache_dir is not None:
+        cache_dir = os.path.abspath(cache_dir)
     orig_dir = os.getcwd()
     os.chdir(source_dir)
-    colabize_directory('.', dest_base, dest_base, url_base, IGNORE_PATTERNS)
+    colabize_directory('.', dest_base, dest_base, url_base, IGNORE_PATTERNS, cache_dir)
     os.chdir(orig_dir)
 
 
-def generate_nbsphinx_src(source_dir, dest_dir):
+def generate_nbsphinx_src(source_dir, dest_dir, cache_dir=None, extraction_threshold=None, split_thresholds=None, execute=False, term_index_dir=None):
+    outputs_dir = None if extraction_threshold is None else os.path.join(dest_dir, OUTPUTS_DIR)
     os.makedirs(dest_dir)
-    shutil.copytree(source_dir, dest_dir, ignore=shutil.ignore_patterns(*IGNORE_PATTERNS), dirs_exist_ok=True)
-    for basedir, _, fnames in os.walk(dest_dir):
-        for fname in fnames:
-            if fname.endswith('.ipynb'):
-                path = os.path.join(basedir, fname)
-                sanitize_ipynb(path, path)
+    files = scan_tree(source_dir, IGNORE_PATTERNS)
+    execution_root, execution_context = (dest_dir, tree_digest(source_dir, files)) if execute else (None, b'')
+    # Other files are copied first since notebooks are executed in the destination
+    for f in sorted(files, key=lambda f: f.relpath.endswith('.ipynb')):
+        source, dest = os.path.join(source_dir, f.relpath), os.path.join(dest_dir, f.relpath)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        if f.relpath.endswith('.ipynb'):
+            sanitize_ipynb(source, dest, cache_dir, outputs_dir, extraction_threshold, execution_root, execution_context)
+        else:
+            shutil.copy2(source, dest)
+    clear_scan_cache()
+    if split_thresholds is not None:
+        split_directory(dest_dir, *split_thresholds, term_index_dir)
+
+
+def deploy_directory(source_dir, dest_dir, ignore_patterns=DEPLOY_IGNORE_PATTERNS):
+    source_files = {f.relpath: f.stat for f in scan_tree(source_dir, ignore_patterns)}
+    dest_files = {f.relpath: f.stat for f in scan_tree(dest_dir, ignore_patterns)}
+    added = sorted(source_files.keys() - dest_files.keys())
+    removed = sorted(dest_files.keys() - source_files.keys())
+    changed = sorted(x for x in source_files.keys() & dest_files.keys()
+                     if source_files[x].st_size != dest_files[x].st_size
+                     or not filecmp.cmp(os.path.join(source_dir, x), os.path.join(dest_dir, x), shallow=False))
+
+    # Removed first so that a path turning from a directory into a file (or vice versa) is free to be copied
+    for relpath in removed:
+        os.remove(os.path.join(dest_dir, relpath))
+        # Remove directories emptied by the deletion
+        dirpath = os.path.dirname(relpath)
+        while dirpath and not os.listdir(os.path.join(dest_dir, dirpath)):
+            os.rmdir(os.path.join(dest_dir, dirpath))
+            dirpath = os.path.dirname(dirpath)
+    for relpath in itertools.chain(added, changed):
+        dest = os.path.join(dest_dir, relpath)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        # A directory left with ignored files (e.g., .git) where a file is deployed
+        if os.path.isdir(dest) and not os.path.islink(dest):
+            shutil.rmtree(dest)
+        shutil.copy2(os.path.join(source_dir, relpath), dest)
+    clear_scan_cache()
+
+    print(f'{dest_dir} deployed: {len(added)} added, {len(changed)} changed, {len(removed)} removed')
+    for mark, relpaths in (('+', added), ('M', changed), ('-', removed)):
+        for relpath in relpaths:
+            print(f'  {mark}', relpath)
+
+
+def compress_directory(source_dir):
+    total_original, total_compressed = 0, 0
+    print(f'{source_dir} compressed:')
+    for f in scan_tree(source_dir, IGNORE_PATTERNS):
+        relpath = f.relpath
+        path = os.path.join(source_dir, relpath)
+        if relpath.endswith('.ipynb'):
+            sizes = minify_ipynb(path)
+        elif relpath.endswith(COMPRESSIBLE_EXTENSIONS):
+            sizes = gzip_file(path)
+        else:
+            continue
+        if sizes is None:
+            continue
+        original, compressed = sizes
+        total_original += original
+        total_compressed += compressed
+        print(f'  - {relpath}: {original} -> {compressed} bytes (-{original - compressed})')
+    print(f'  total: {total_original} -> {total_compressed} bytes (-{total_original - total_compressed})')
+    clear_scan_cache()
+
+
+def minify_ipynb(path):
+    with open(path, 'rb') as f:
+        original = f.read()
+    minified = json.dumps(json.loads(original), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    if len(minified) >= len(original):
+        return None
+    with open(path, 'wb') as f:
+        f.write(minified)
+    return (len(original), len(minified))
+
+
+def gzip_file(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    # Fix mtime so that unchanged files yield identical archives for differential deployment
+    compressed = gzip.compress(data, compresslevel=9, mtime=0)
+    if len(compressed) >= len(data):
+        return None
+    with open(f'{path}.gz', 'wb') as f:
+        f.write(compressed)
+    return (len(data), len(compressed))
 
 
 if __name__ == '__main__':
@@ -94,6 +94,7 @@ html_sidebars = {
         'navigation.html',
         'relations.html',
         'searchbox.html',
+        'term_search.html',
         'donate.html',
     ]
 }
@@ -102,6 +103,10 @@ html_search_language = 'ja'
 
 html_show_sourcelink = False
 
+# Sharded index of terms generated by index_generator.py for term_search.html
+# (contents of extra paths are copied into the root, so shards are in term_extra/term_index)
+html_extra_path = ['term_extra']
+
 html_context = {
     'colab_base_url': f'https://colab.research.google.com/github/{github_username}/{github_reponame}/blob/{github_branch}/{colab_dir}',
     'github_url': f'https://github.com/{github_username}/{github_reponame}',
@@ -0,0 +1,150 @@
+#! /usr/bin/env python3
+
+import os
+import re
+import struct
+import argparse
+import concurrent.futures
+
+from ipynb_common import cache_key, source_digest, cached, write_file, cache_statistics
+
+OUTPUT_THRESHOLD = 32 * 1024
+
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+OUTPUT_LOADER = '<button class="output-loader" onclick="var t = this.nextElementSibling; t.replaceWith(t.content); this.remove();">Show output ({size} KB)</button>'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('html_dir', help='Specify a directory of HTML built by Sphinx.')
+    parser.add_argument('-C', '--cache_dir', help='Specify a directory of the build cache, from which pages optimized before are restored.')
+    parser.add_argument('-t', '--output_threshold', type=int, default=OUTPUT_THRESHOLD, help=f'Render outputs larger than this in bytes on demand (default: {OUTPUT_THRESHOLD}).')
+    parser.add_argument('-j', '--jobs', type=int, help='Specify the number of processes (default: the number of CPUs).')
+    commandline_args = parser.parse_args()
+
+    assert os.path.isdir(commandline_args.html_dir)
+    optimize_html(commandline_args.html_dir, commandline_args.cache_dir, commandline_args.output_threshold, commandline_args.jobs)
+
+
+def optimize_html(html_dir, cache_dir=None, output_threshold=OUTPUT_THRESHOLD, jobs=None):
+    if cache_dir is not None:
+        cache_dir = os.path.abspath(cache_dir)
+    pages = []
+    for dirpath, _, fnames in os.walk(html_dir):
+        pages.extend(os.path.join(dirpath, f) for f in sorted(fnames) if f.endswith('.html'))
+    pages.sort()
+
+    with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+        processed = sum(executor.map(optimize_page, pages, [cache_dir] * len(pages), [output_threshold] * len(pages)))
+    if cache_dir is not None:
+        # Counted here since worker processes exit without saving their statistics
+        cache_statistics[(cache_dir, 'html', 'misses')] += processed
+        cache_statistics[(cache_dir, 'html', 'hits')] += len(pages) - processed
+    print(f'{html_dir} optimized: {processed} pages processed, {len(pages) - processed} pages restored from the cache')
+
+
+def optimize_page(page, cache_dir, output_threshold):
+    """
+    Optimize a page built by Sphinx through the build cache and return whether it was actually processed.
+    Results are keyed by the page as Sphinx wrote it, so unchanged pages of a rebuild are restored from the cache.
+    """
+    with open(page, 'rb') as f:
+        content = f.read()
+    page_dir = os.path.dirname(page)
+    html = content.decode('utf-8')
+    # Intrinsic sizes of images are part of the result as well
+    sizes = [repr((src, image_size(os.path.join(page_dir, src)))) for src in local_img_sources(html)]
+    key = cache_key(source_digest(__file__), str(output_threshold).encode('utf-8'), content, '\n'.join(sizes).encode('utf-8'))
+    processed = False
+
+    def optimize():
+        nonlocal processed
+        processed = True
+        optimized = re.sub(r'<img\b[^>]*>', lambda m: optimize_img(m[0], page_dir), html)
+        return defer_outputs(optimized, output_threshold).encode('utf-8')
+
+    write_file(page, cached(cache_dir, 'html', key, optimize))
+    return processed
+
+
+def local_img_sources(html):
+    for tag in re.findall(r'<img\b[^>]*>', html):
+        m = re.search(r'\ssrc="([^"]*)"', tag)
+        if m is not None and not re.match(r'[a-z]+:', m[1]):
+            yield m[1].split('#')[0].split('?')[0]
+
+
+def optimize_img(tag, page_dir):
+    attributes = []
+    if not re.search(r'\sloading=', tag):
+        attributes.append('loading="lazy"')
+    if not re.search(r'\sdecoding=', tag):
+        attributes.append('decoding="async"')
+    # Intrinsic size reserves the space of an image before it loads
+    m = re.search(r'\ssrc="([^"]*)"', tag)
+    if m is not None and not re.search(r'\s(width|height|style)=', tag) and not re.match(r'[a-z]+:', m[1]):
+        size = image_size(os.path.join(page_dir, m[1].split('#')[0].split('?')[0]))
+        if size is not None:
+            attributes.append(f'width="{size[0]}" height="{size[1]}" style="height: auto;"')
+    if not attributes:
+        return tag
+    end = -2 if tag.endswith('/>') else -1
+    return f'{tag[:end].rstrip()} {" ".join(attributes)}{tag[end:]}'
+
+
+def image_size(path):
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(24)
+            if head[:8] == b'\x89PNG\r\n\x1a\n':
+                return struct.unpack('>II', head[16:24])
+            if head[:6] in (b'GIF87a', b'GIF89a'):
+                return struct.unpack('<HH', head[6:10])
+            if head[:2] == b'\xff\xd8':
+                f.seek(2)
+                while (marker := f.read(2)) and marker[0] == 0xFF:
+                    if marker[1] in JPEG_SOF_MARKERS:
+                        height, width = struct.unpack('>3xHH', f.read(7))
+                        return (width, height)
+                    f.seek(struct.unpack('>H', f.read(2))[0] - 2, os.SEEK_CUR)
+    except (OSError, struct.error):
+        pass
+    return None
+
+
+def defer_outputs(html, output_threshold):
+    """
+    Move large output areas of nbsphinx into <template> rendered on demand.
+    Outputs with scripts are left as they are since scripts in <template> would not run.
+    """
+    chunks = []
+    pos = 0
+    for m in re.finditer(r'<div class="[^"]*\boutput_area\b[^"]*">', html):
+        if m.start() < pos:
+            continue
+        end = find_closing_div(html, m.end())
+        if end is None:
+            break
+        inner = html[m.end():end]
+        if len(inner.encode('utf-8')) <= output_threshold or '<script' in inner or 'output-loader' in inner:
+            continue
+        chunks.append(html[pos:m.end()])
+        chunks.append(OUTPUT_LOADER.format(size=len(inner.encode('utf-8')) // 1024))
+        chunks.append(f'<template>{inner}</template>')
+        pos = end
+    chunks.append(html[pos:])
+    return ''.join(chunks)
+
+
+def find_closing_div(html, pos):
+    depth = 1
+    for m in re.compile(r'<(/?)div\b').finditer(html, pos):
+        depth += -1 if m[1] else 1
+        if depth == 0:
+            return m.start()
+    return None
+
+
+if __name__ == '__main__':
+    main()
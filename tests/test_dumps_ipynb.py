@@ -0,0 +1,142 @@
+import os
+import sys
+import json
+import glob
+import math
+import random
+import collections
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ipynb_common import dumps_ipynb, write_ipynb, markdown_to_ipynb, COMMON_METADATA
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def expected_bytes(ipynb):
+    return (json.dumps(ipynb, indent=1, ensure_ascii=False) + '\n').encode('utf-8')
+
+
+class Str(str):
+    pass
+
+
+class Int(int):
+    pass
+
+
+def example_notebook():
+    return {
+        'cells': [
+            {
+                'cell_type': 'markdown',
+                'id': 'a1',
+                'metadata': {},
+                'source': ['# 見出し\n', '\n', '**用語** と `code`、"quotes" \\ backslash\t tab\n', 'last line'],
+            },
+            {
+                'cell_type': 'code',
+                'execution_count': 3,
+                'id': 'b2',
+                'metadata': {'tags': ['hide-input'], 'nbsphinx': 'hidden', 'scrolled': True},
+                'outputs': [
+                    {'name': 'stdout', 'output_type': 'stream', 'text': ['0.1\n', '\x1b[31mred\x1b[0m\n']},
+                    {
+                        'data': {
+                            'image/png': 'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg==\n',
+                            'text/plain': ['<Figure size 640x480 with 1 Axes>'],
+                        },
+                        'metadata': {'needs_background': 'light', 'image/png': {'width': 640, 'height': 480.5}},
+                        'output_type': 'display_data',
+                    },
+                    {
+                        'ename': 'ZeroDivisionError',
+                        'evalue': 'division by zero',
+                        'output_type': 'error',
+                        'traceback': ['\x1b[0;31m---------\x1b[0m', 'Traceback\r\n'],
+                    },
+                ],
+                'source': ['x = 1 / 0\n', 'print(x)'],
+            },
+            {'cell_type': 'code', 'execution_count': None, 'metadata': {}, 'outputs': [], 'source': []},
+            {'cell_type': 'raw', 'metadata': {}, 'source': ''},
+        ],
+        'metadata': dict(COMMON_METADATA, widgets={'state': {}, 'version': '1.1.2'}),
+        'nbformat': 4,
+        'nbformat_minor': 4,
+    }
+
+
+def random_value(rng, depth=0):
+    r = rng.random()
+    if depth < 4 and r < 0.2:
+        return {rng.choice(['a', 'é', '\n"k', '', 'あ', 1, -2.5, True, False, None]): random_value(rng, depth + 1)
+                for _ in range(rng.randint(0, 4))}
+    if depth < 4 and r < 0.4:
+        return [random_value(rng, depth + 1) for _ in range(rng.randint(0, 4))]
+    if depth < 4 and r < 0.5:
+        return [rng.choice(['x\n', '\t\\', '\x00\x1f\x7f', 'あ ', '']) for _ in range(rng.randint(0, 3))]
+    return rng.choice(['s', ' ', 0, -7, 10 ** 40, 1.5, 1e-7, 1e16, -0.0, 5e-324,
+                       math.nan, math.inf, -math.inf, True, False, None, (1, 'a'), ()])
+
+
+CORPUS = [
+    example_notebook(),
+    markdown_to_ipynb(['# Title\n', '\n', '- [a](a.ipynb#見出し)\n']),
+    {'cells': [], 'metadata': {}, 'nbformat': 4, 'nbformat_minor': 5},
+] + [random_value(random.Random(seed)) for seed in range(500)]
+
+
+@pytest.mark.parametrize('ipynb', CORPUS)
+def test_corpus(ipynb):
+    assert dumps_ipynb(ipynb) == expected_bytes(ipynb)
+
+
+@pytest.mark.parametrize('path', sorted(glob.glob(os.path.join(REPO_DIR, '**', '*.ipynb'), recursive=True)))
+def test_repository_notebooks(path):
+    with open(path, encoding='utf-8') as f:
+        ipynb = json.load(f)
+    assert dumps_ipynb(ipynb) == expected_bytes(ipynb)
+
+
+@pytest.mark.parametrize('value', [
+    [], {}, [[]], [{}], {'a': []}, {'a': {}},
+    math.nan, math.inf, -math.inf, [math.nan, math.inf, -math.inf], {'x': math.nan},
+    {7: 'int', 2.5: 'float', True: 'bool', None: 'none'},
+    {False: [], 0.1: {}},
+    Str('sub'), [Str('a'), 'b'], {Str('key'): Str('value')},
+    Int(3), True, [Int(-1), False],
+    (), ('a', 'b'), (1, ('x', [])), {'t': ('a', 1)},
+    'ascii', 'non-ASCII: 日本語 éß    😀',
+    '\x00\x01\x08\x0c\x1f\x7f "\\/\n\r\t',
+    ['\x00', '\u001f', '\b\f'],
+    10 ** 100, -10 ** 100, 0.1, -0.0, 1e300, 1e-300,
+    collections.OrderedDict([('b', 1), ('a', 2)]),
+])
+def test_edge_cases(value):
+    assert dumps_ipynb(value) == expected_bytes(value)
+
+
+def test_unserializable():
+    with pytest.raises(TypeError):
+        dumps_ipynb({'a': object()})
+    with pytest.raises(TypeError):
+        dumps_ipynb({('a',): 1})
+
+
+def test_write_ipynb(tmp_path):
+    path = tmp_path / 'a.ipynb'
+    ipynb = example_notebook()
+    assert write_ipynb(path, ipynb)
+    assert path.read_bytes() == expected_bytes(ipynb)
+    stat = os.stat(path)
+    # The same bytes are not written again
+    assert not write_ipynb(path, ipynb)
+    assert os.stat(path).st_mtime_ns == stat.st_mtime_ns
+    assert os.stat(path).st_ino == stat.st_ino
+    ipynb['nbformat_minor'] = 5
+    assert write_ipynb(path, ipynb)
+    assert path.read_bytes() == expected_bytes(ipynb)
+    assert os.listdir(tmp_path) == ['a.ipynb']
@@ -7,7 +7,7 @@ import json
 import itertools
 import shutil
 
-from ipynb_common import path_iter, markdown_to_ipynb
+from ipynb_common import path_iter, markdown_to_ipynb, write_ipynb, cache_key, source_digest, cached
 
 MAX_HEADING_LEVEL = 2
 
@@ -22,6 +22,7 @@ def main():
     parser.add_argument('-t', '--title', default=TITLE, help='Specify the title of TOC (default: {TITLE}).')    
     parser.add_argument('-l', '--max_heading_level', default=MAX_HEADING_LEVEL, help=f'Specify the max level of headings in TOC (default: {MAX_HEADING_LEVEL}).')
     parser.add_argument('-p', '--preamble', help='Specify the file of the preamble of TOC.')
+    parser.add_argument('-C', '--cache_dir', help='Specify a directory of the build cache shared among versions and builds on a host.')
     commandline_args = parser.parse_args()
 
     preamble = ''
@@ -29,17 +30,15 @@ def main():
         with open(commandline_args.preamble, encoding='utf-8') as f:
             preamble = f.read()
 
-    ipynb = toc_ipynb(commandline_args.source, commandline_args.max_heading_level, commandline_args.title, preamble)
-    with open(f'{commandline_args.name}.ipynb', 'w', encoding='utf-8') as f:
-        json.dump(ipynb, f, indent=1, ensure_ascii=False)
-        f.write('\n')
+    ipynb = toc_ipynb(commandline_args.source, commandline_args.max_heading_level, commandline_args.title, preamble, commandline_args.cache_dir)
+    write_ipynb(f'{commandline_args.name}.ipynb', ipynb)
     rst = toc_rst(commandline_args.source, commandline_args.max_heading_level, commandline_args.title, preamble)
     with open(f'{commandline_args.name}.rst', 'w', encoding='utf-8') as f:
         f.write(rst)
 
 
 def toc_rst(source, heading_depth, title, preamble):
-    doclist = '\n   '.join(os.path.splitext(os.path.relpath(x, source))[0] for x in sorted(path_iter(source)))
+    doclist = '\n   '.join(os.path.splitext(os.path.relpath(x, source))[0] for x in path_iter(source))
     underline = '=' * (len(title) * 2)
     return f"""
 {title}
@@ -54,11 +53,13 @@ def toc_rst(source, heading_depth, title, preamble):
 """
 
 
-def toc_ipynb(source, heading_level, title, preamble):
+def toc_ipynb(source, heading_level, title, preamble, cache_dir=None):
     markdown_lines = [f'# {title}\n', *preamble.splitlines(keepends=True), '\n']
-    for notebook in sorted(path_iter(source)):
-        with open(os.path.join(notebook), encoding='utf-8') as f:
-            headings = extract_headings(json.load(f))
+    for notebook in path_iter(source):
+        with open(notebook, 'rb') as f:
+            content = f.read()
+        headings = iter(json.loads(cached(cache_dir, 'headings', cache_key(source_digest(__file__), content),
+                                          lambda: json.dumps(list(extract_headings(json.loads(content)))).encode('utf-8'))))
         level, heading = next(headings)
         assert level == 1, (level, heading)
         markdown_lines.append(f'## [{heading}]({os.path.relpath(notebook, source)})\n')